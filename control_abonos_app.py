@@ -1,15 +1,27 @@
 import os
 import glob
+import csv
+import functools
+import hmac
+import queue
 import re
 import zipfile
+import tempfile
+import threading
+import time
 import streamlit as st
 import sqlite3
+import numpy as np
 import pandas as pd
 import logging
-from io import BytesIO
+import xlsxwriter
+from contextlib import contextmanager
+from io import BytesIO, TextIOWrapper
 from datetime import date, datetime
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils import get_column_letter
-from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
+from openpyxl.styles import Font, PatternFill, Border, Side, Alignment, NamedStyle
 
 # ------------------ Config / Logging ------------------
 logging.basicConfig(
@@ -19,25 +31,67 @@ logging.basicConfig(
 )
 
 DB_FILENAME_TEMPLATE = "control_abonos_{user}.db"
+# xlsxwriter exports at least this large are written in constant_memory mode (temp file)
+EXCEL_CONSTANT_MEMORY_ROWS = 50_000
+# applied once to each cached connection
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-20000",  # ~20MB page cache, kept warm by the long-lived connection
+    "PRAGMA temp_store=MEMORY",  # sorts/GROUP BY temp tables stay off disk
+    "PRAGMA mmap_size=268435456",  # read pages through a 256MB mmap instead of pread
+    "PRAGMA busy_timeout=5000",  # wait for another session's write instead of failing with 'database is locked'
+)
+# the read-only connections skip journal_mode/synchronous, which only matter to the writer
+READ_CONNECTION_PRAGMAS = CONNECTION_PRAGMAS[2:]
+# idle read-only connections kept per DB file; extra concurrent readers open and close their own
+READ_POOL_SIZE = 4
+# bump whenever init_db creates new tables, columns or indexes
+SCHEMA_VERSION = 2
 
 # ------------------ Helpers DB per user ------------------
 
 
+_USER_SANITIZER = re.compile(r"[^A-Za-z0-9_-]")
+
+
+@functools.lru_cache(maxsize=128)
 def sanitize_username(username: str) -> str:
-    if not username:
-        return "anonymous"
-    return re.sub(r"[^A-Za-z0-9_-]", "_", username)
+    return _USER_SANITIZER.sub("_", username) if username else "anonymous"
 
 
+@functools.lru_cache(maxsize=128)
 def get_db_path_for_user(username: str) -> str:
     safe = sanitize_username(username)
     return DB_FILENAME_TEMPLATE.format(user=safe)
 
 
+class LockedConnection(sqlite3.Connection):
+    """
+    Connection whose "with conn:" blocks are serialized by a lock: the cached connection is
+    shared by every session of the same user, and sqlite3 would otherwise let two threads'
+    statements interleave inside one transaction.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tx_lock = threading.RLock()
+
+    def __enter__(self):
+        self._tx_lock.acquire()
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        try:
+            return super().__exit__(*exc_info)
+        finally:
+            self._tx_lock.release()
+
+
 def get_connection_for_user(username: str):
     db_path = get_db_path_for_user(username)
     try:
-        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn = sqlite3.connect(db_path, check_same_thread=False, factory=LockedConnection)
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA foreign_keys = ON")
         return conn
@@ -47,6 +101,121 @@ def get_connection_for_user(username: str):
         st.stop()
 
 
+@st.cache_resource(show_spinner=False)
+def _connection_registry() -> dict:
+    # process-wide writer connection and read-only pool per DB file; close_connections()
+    # closes and drops the ones of a given file before it is deleted
+    return {"lock": threading.Lock(), "writers": {}, "read_pools": {}}
+
+
+def _open_writer_conn(username: str):
+    conn = get_connection_for_user(username)
+    for pragma in CONNECTION_PRAGMAS:
+        try:
+            conn.execute(pragma)
+        except sqlite3.Error:
+            # e.g. journal_mode=WAL on a read-only filesystem; the connection still works without it
+            logging.exception("No se pudo aplicar %s", pragma)
+    init_db(conn)
+    return conn
+
+
+def get_conn(username: str):
+    """
+    Returns the long-lived connection for the user's DB, shared across reruns.
+    Keyed by DB path so usernames that sanitize to the same file share one connection.
+    """
+    db_path = get_db_path_for_user(username)
+    registry = _connection_registry()
+    conn = registry["writers"].get(db_path)
+    if conn is None:
+        with registry["lock"]:
+            conn = registry["writers"].get(db_path)
+            if conn is None:
+                # created once per process per DB file, so init_db runs here instead of on every rerun
+                conn = _open_writer_conn(username)
+                registry["writers"][db_path] = conn
+    return conn
+
+
+def _read_pool(db_path: str) -> queue.Queue:
+    registry = _connection_registry()
+    with registry["lock"]:
+        return registry["read_pools"].setdefault(db_path, queue.Queue(maxsize=READ_POOL_SIZE))
+
+
+def _open_read_conn(db_path: str):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    # no sqlite3.Row factory: these only feed DataFrames and the CSV writer, and plain
+    # tuples make read_sql_query ~30% faster on large tables
+    for pragma in READ_CONNECTION_PRAGMAS:
+        try:
+            conn.execute(pragma)
+        except sqlite3.Error:
+            logging.exception("No se pudo aplicar %s", pragma)
+    return conn
+
+
+@contextmanager
+def read_conn(username: str):
+    """
+    Borrows a read-only connection to the user's DB from a small per-file pool, so
+    concurrent sessions' reads don't serialize on the shared writer connection.
+    """
+    # the writer connection creates the file and schema before it is opened read-only
+    get_conn(username)
+    db_path = get_db_path_for_user(username)
+    pool = _read_pool(db_path)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_read_conn(db_path)
+    try:
+        yield conn
+    finally:
+        # a pool dropped by close_connections while this was borrowed no longer takes it back
+        if _connection_registry()["read_pools"].get(db_path) is not pool:
+            conn.close()
+        else:
+            try:
+                pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+
+def close_connections(db_paths):
+    """
+    Closes and forgets the writer connection and pooled read-only connections of the given
+    DB files; must run before the files are deleted (open handles keep them locked on Windows).
+    Other users' connections are left alone.
+    """
+    registry = _connection_registry()
+    with registry["lock"]:
+        for db_path in db_paths:
+            writer = registry["writers"].pop(db_path, None)
+            pool = registry["read_pools"].pop(db_path, None)
+            try:
+                if writer is not None:
+                    # waits for a transaction another session may be running on it
+                    with writer._tx_lock:
+                        writer.close()
+                while pool is not None:
+                    try:
+                        pool.get_nowait().close()
+                    except queue.Empty:
+                        break
+            except sqlite3.Error:
+                logging.exception("No se pudo cerrar la conexión a %s", db_path)
+
+
+def reset_connection_cache(db_paths=()):
+    # after DB files are deleted: their connections were closed by delete_file, so the next
+    # access recreates the files; the version bump invalidates every cached read of them
+    for db_path in db_paths:
+        _bump_path_version(db_path)
+    clear_read_caches()
+
+
 def ensure_column(conn, table: str, column: str, col_type: str):
     c = conn.cursor()
     info = c.execute(f"PRAGMA table_info({table})").fetchall()
@@ -62,6 +231,11 @@ def ensure_column(conn, table: str, column: str, col_type: str):
 
 def init_db(conn):
     c = conn.cursor()
+    # DBs already at the current schema skip the CREATE/PRAGMA table_info probes below
+    if c.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+    # sqlite3 autocommits each DDL statement on its own; one explicit transaction syncs once
+    c.execute("BEGIN")
     c.execute(
         """
         CREATE TABLE IF NOT EXISTS casos (
@@ -88,204 +262,650 @@ def init_db(conn):
         )
         """
     )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_casos_cliente_etapa ON casos(cliente, etapa)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_casos_etapa ON casos(etapa)")
+    # covering index: SUM(monto) per caso is answered from the index alone
+    c.execute("CREATE INDEX IF NOT EXISTS idx_abonos_caso_monto ON abonos(caso_id, monto)")
+    # superseded by the composite indexes above
+    c.execute("DROP INDEX IF EXISTS idx_casos_cliente")
+    c.execute("DROP INDEX IF EXISTS idx_abonos_caso_id")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_abonos_fecha ON abonos(fecha DESC, id DESC)")
+    try:
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_casos_cliente_desc ON casos(cliente, descripcion)")
+        unique_ok = True
+    except sqlite3.IntegrityError:
+        # older DBs may already hold duplicates (e.g. created via edit); add_caso/add_casos_bulk
+        # check for duplicates themselves until the index exists
+        logging.exception("No se pudo crear el índice único casos(cliente, descripcion)")
+        unique_ok = False
     conn.commit()
     ensure_column(conn, "casos", "creado_por", "TEXT")
     ensure_column(conn, "abonos", "creado_por", "TEXT")
+    # without the unique index the schema is not current: leave user_version alone so the
+    # next connection retries it (e.g. once the duplicates have been fixed)
+    if unique_ok:
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
 
 
 # ------------------ CRUD ------------------
 
 
-def fetch_casos(conn, cliente_filter=None, etapa_filter=None):
-    q = "SELECT * FROM casos"
+_CASOS_ALL_SQL = "SELECT * FROM casos ORDER BY id"
+# explicit projection: only the columns the Abonos tab shows, whatever else the tables grow
+_ABONOS_SELECT = """SELECT a.id, a.fecha, a.monto, a.caso_id, a.observaciones, a.creado_en, a.creado_por,
+                  c.cliente, c.descripcion
+           FROM abonos a JOIN casos c ON a.caso_id = c.id"""
+_ABONOS_ALL_SQL = _ABONOS_SELECT + " ORDER BY a.fecha DESC, a.id DESC"
+_ABONOS_BY_CASO_SQL = _ABONOS_SELECT + " WHERE a.caso_id = ? ORDER BY a.fecha DESC, a.id DESC"
+
+
+def _build_caso_where(cliente_filter=None, etapa_filter=None, alias: str = "") -> tuple[str, list]:
+    # (" WHERE ...", params) for the casos filters; "Todos"/empty means no filter
     params, conditions = [], []
     if cliente_filter and cliente_filter != "Todos":
-        conditions.append("cliente = ?")
+        conditions.append(f"{alias}cliente = ?")
         params.append(cliente_filter)
     if etapa_filter and etapa_filter != "Todos":
-        conditions.append("etapa = ?")
+        conditions.append(f"{alias}etapa = ?")
         params.append(etapa_filter)
-    if conditions:
-        q += " WHERE " + " AND ".join(conditions)
-    q += " ORDER BY id"
-    return pd.read_sql_query(q, conn, params=params)
+    if not conditions:
+        return "", params
+    return " WHERE " + " AND ".join(conditions), params
+
+
+def fetch_casos(conn, cliente_filter=None, etapa_filter=None):
+    where, params = _build_caso_where(cliente_filter, etapa_filter)
+    if not where:
+        # constant SQL text so sqlite3's statement cache reuses the prepared statement
+        return pd.read_sql_query(_CASOS_ALL_SQL, conn)
+    return pd.read_sql_query("SELECT * FROM casos" + where + " ORDER BY id", conn, params=params)
+
+
+def filter_by_caso(df: pd.DataFrame, cliente_filter=None, etapa_filter=None) -> pd.DataFrame:
+    # in-memory equivalent of _build_caso_where for casos/resumen frames; "Todos"/empty means no filter
+    mask = np.ones(len(df), dtype=bool)
+    if cliente_filter and cliente_filter != "Todos":
+        mask &= df["cliente"].eq(cliente_filter).to_numpy(dtype=bool, na_value=False)
+    if etapa_filter and etapa_filter != "Todos":
+        mask &= df["etapa"].eq(etapa_filter).to_numpy(dtype=bool, na_value=False)
+    return df if mask.all() else df[mask]
 
 
 def fetch_abonos(conn, caso_id=None):
-    q = """SELECT abonos.*, casos.cliente, casos.descripcion
-           FROM abonos JOIN casos ON abonos.caso_id = casos.id"""
-    params = []
     if caso_id:
-        q += " WHERE caso_id = ?"
-        params.append(caso_id)
-    q += " ORDER BY fecha DESC, id DESC"
-    df = pd.read_sql_query(q, conn, params=params)
-    # normalize fecha to date-only for display (store may contain date string)
+        df = pd.read_sql_query(_ABONOS_BY_CASO_SQL, conn, params=(caso_id,))
+    else:
+        df = pd.read_sql_query(_ABONOS_ALL_SQL, conn)
+    # fecha is stored as ISO YYYY-MM-DD: parse with the ISO fast path (which also takes a time
+    # part) and keep it as datetime64 (no per-row date objects); display code formats it as a date
     if not df.empty and "fecha" in df.columns:
         try:
-            df["fecha"] = pd.to_datetime(df["fecha"], errors="coerce").dt.date
+            raw = df["fecha"]
+            parsed = pd.to_datetime(raw, format="ISO8601", errors="coerce", cache=True)
+            # older rows in other formats: slow per-value parse, only for those
+            retry = parsed.isna() & raw.notna()
+            if retry.any():
+                parsed[retry] = pd.to_datetime(raw[retry], format="mixed", dayfirst=True, errors="coerce")
+            df["fecha"] = parsed
         except Exception:
             logging.exception("No se pudo convertir columna fecha a date")
     return df
 
 
+def has_unique_caso_index(conn) -> bool:
+    # missing on legacy DBs that already held duplicate (cliente, descripcion) pairs, see init_db
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_casos_cliente_desc'"
+    ).fetchone() is not None
+
+
 def add_caso(conn, cliente, descripcion, valor_acordado, etapa, observaciones, creado_por=None):
     if not cliente or str(cliente).strip() == "":
         raise ValueError("El nombre del cliente es obligatorio.")
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM casos WHERE cliente = ? AND descripcion = ?", (cliente, descripcion))
-    if c.fetchone()[0] > 0:
-        raise ValueError("Ya existe un caso con ese cliente y descripción.")
-    created_date = datetime.utcnow().date().isoformat()  # date-only
-    c.execute(
-        "INSERT INTO casos (cliente, descripcion, valor_acordado, etapa, observaciones, creado_en, creado_por) VALUES (?,?,?,?,?,?,?)",
-        (cliente.strip(), descripcion, float(valor_acordado or 0), etapa, observaciones, created_date, creado_por),
-    )
-    conn.commit()
+    # conn.execute reuses sqlite3's per-connection statement cache; "with conn" commits or rolls back
+    with conn:
+        if not has_unique_caso_index(conn) and conn.execute(
+            "SELECT 1 FROM casos WHERE cliente = ? AND descripcion = ? LIMIT 1", (cliente.strip(), descripcion)
+        ).fetchone():
+            raise ValueError("Ya existe un caso con ese cliente y descripción.")
+        # the unique (cliente, descripcion) index rejects duplicates in the same statement
+        row = conn.execute(
+            """INSERT INTO casos (cliente, descripcion, valor_acordado, etapa, observaciones, creado_por)
+               VALUES (?,?,?,?,?,?) ON CONFLICT DO NOTHING RETURNING id""",
+            (cliente.strip(), descripcion, float(valor_acordado or 0), etapa, observaciones, creado_por),
+        ).fetchone()
+        if row is None:
+            raise ValueError("Ya existe un caso con ese cliente y descripción.")
     logging.info("Caso agregado: %s - %s (por %s)", cliente, descripcion, creado_por)
-    return c.lastrowid
+    return row[0]
 
 
 def edit_caso(conn, caso_id, cliente, descripcion, valor_acordado, etapa, observaciones):
-    c = conn.cursor()
-    c.execute(
-        "UPDATE casos SET cliente=?, descripcion=?, valor_acordado=?, etapa=?, observaciones=? WHERE id=?",
-        (cliente, descripcion, float(valor_acordado or 0), etapa, observaciones, caso_id),
-    )
-    conn.commit()
+    with conn:
+        c = conn.execute(
+            "UPDATE casos SET cliente=?, descripcion=?, valor_acordado=?, etapa=?, observaciones=? WHERE id=?",
+            (cliente, descripcion, float(valor_acordado or 0), etapa, observaciones, caso_id),
+        )
     logging.info("Caso editado id=%s", caso_id)
     return c.rowcount
 
 
 def delete_caso(conn, caso_id):
-    c = conn.cursor()
-    c.execute("DELETE FROM abonos WHERE caso_id = ?", (caso_id,))
-    c.execute("DELETE FROM casos WHERE id = ?", (caso_id,))
-    conn.commit()
+    # abonos go with it through ON DELETE CASCADE (foreign_keys is ON for every connection)
+    with conn:
+        conn.execute("DELETE FROM casos WHERE id = ?", (caso_id,))
     logging.info("Caso eliminado id=%s", caso_id)
 
 
-def add_abono(conn, fecha, monto, caso_id, observaciones, creado_por=None):
-    c = conn.cursor()
+def fecha_to_iso(fecha) -> str:
+    if isinstance(fecha, datetime):
+        return fecha.date().isoformat()
+    if isinstance(fecha, date):
+        return fecha.isoformat()
+    try:
+        return date.fromisoformat(str(fecha).strip()).isoformat()
+    except ValueError:
+        pass
+    # non-ISO strings (e.g. from CSV imports) go through the slower pandas parser,
+    # day first as in "02/03/2024" = 2 de marzo
+    try:
+        parsed = pd.to_datetime(fecha, dayfirst=True)
+    except (ValueError, TypeError):
+        parsed = pd.NaT
+    if pd.isna(parsed):
+        raise ValueError(f"Fecha inválida: {fecha!r}.")
+    return parsed.date().isoformat()
+
+
+def _abono_ids_and_monto(caso_id, monto) -> tuple[int, float]:
+    # shared validation for add_abono / add_abonos_bulk
     try:
         caso_id_int = int(caso_id)
     except Exception:
         raise ValueError("ID de caso inválido.")
-    c.execute("SELECT 1 FROM casos WHERE id = ?", (caso_id_int,))
-    if c.fetchone() is None:
-        raise ValueError(f"No existe el caso con id {caso_id_int}.")
     try:
         monto_val = float(monto)
     except Exception:
         raise ValueError("Monto inválido.")
     if monto_val <= 0:
         raise ValueError("El monto debe ser mayor que cero.")
-    if isinstance(fecha, date):
-        fecha_iso = fecha.isoformat()
-    else:
-        try:
-            fecha_iso = pd.to_datetime(fecha).date().isoformat()
-        except Exception:
-            fecha_iso = datetime.utcnow().date().isoformat()
-    created_date = datetime.utcnow().date().isoformat()
-    c.execute(
-        "INSERT INTO abonos (fecha, monto, caso_id, observaciones, creado_en, creado_por) VALUES (?,?,?,?,?,?)",
-        (fecha_iso, monto_val, caso_id_int, observaciones, created_date, creado_por),
-    )
-    conn.commit()
+    return caso_id_int, monto_val
+
+
+def add_abono(conn, fecha, monto, caso_id, observaciones, creado_por=None):
+    caso_id_int, monto_val = _abono_ids_and_monto(caso_id, monto)
+    fecha_iso = fecha_to_iso(fecha)
+    try:
+        # the caso_id foreign key rejects unknown casos, no SELECT round trip needed
+        with conn:
+            c = conn.execute(
+                "INSERT INTO abonos (fecha, monto, caso_id, observaciones, creado_por) VALUES (?,?,?,?,?)",
+                (fecha_iso, monto_val, caso_id_int, observaciones, creado_por),
+            )
+    except sqlite3.IntegrityError:
+        raise ValueError(f"No existe el caso con id {caso_id_int}.")
     logging.info("Abono agregado: caso_id=%s monto=%s fecha=%s por=%s", caso_id_int, monto_val, fecha_iso, creado_por)
     return c.lastrowid
 
 
 def edit_abono(conn, abono_id, fecha, monto, caso_id, observaciones):
-    c = conn.cursor()
-    if isinstance(fecha, date):
-        fecha_iso = fecha.isoformat()
-    else:
-        try:
-            fecha_iso = pd.to_datetime(fecha).date().isoformat()
-        except Exception:
-            fecha_iso = datetime.utcnow().date().isoformat()
-    c.execute(
-        "UPDATE abonos SET fecha=?, monto=?, caso_id=?, observaciones=? WHERE id=?",
-        (fecha_iso, float(monto), int(caso_id), observaciones, int(abono_id)),
-    )
-    conn.commit()
+    fecha_iso = fecha_to_iso(fecha)
+    with conn:
+        c = conn.execute(
+            "UPDATE abonos SET fecha=?, monto=?, caso_id=?, observaciones=? WHERE id=?",
+            (fecha_iso, float(monto), int(caso_id), observaciones, int(abono_id)),
+        )
     logging.info("Abono editado id=%s", abono_id)
     return c.rowcount
 
 
+def add_casos_bulk(conn, rows, creado_por=None):
+    """
+    Inserts many casos in a single transaction.
+    rows: iterable of (cliente, descripcion, valor_acordado, etapa, observaciones).
+    A duplicated cliente/descripcion rolls back the whole batch.
+    """
+    data = []
+    for cliente, descripcion, valor_acordado, etapa, observaciones in rows:
+        if not cliente or str(cliente).strip() == "":
+            raise ValueError("El nombre del cliente es obligatorio.")
+        try:
+            valor = float(valor_acordado or 0)
+        except Exception:
+            raise ValueError(f"Valor acordado inválido para {cliente}.")
+        data.append((str(cliente).strip(), descripcion, valor, etapa, observaciones, creado_por))
+    duplicate_msg = "Hay casos que ya existen (mismo cliente y descripción); no se importó ninguno."
+    try:
+        with conn:
+            if not has_unique_caso_index(conn):
+                # no constraint to rely on: check against the table and within the batch
+                # (NULL descripcion never matches, as with the unique index)
+                seen = {(r[0], r[1]) for r in conn.execute("SELECT cliente, descripcion FROM casos WHERE descripcion IS NOT NULL")}
+                for cliente, descripcion, *_ in data:
+                    if descripcion is not None:
+                        if (cliente, descripcion) in seen:
+                            raise ValueError(duplicate_msg)
+                        seen.add((cliente, descripcion))
+            conn.executemany(
+                "INSERT INTO casos (cliente, descripcion, valor_acordado, etapa, observaciones, creado_por) VALUES (?,?,?,?,?,?)",
+                data,
+            )
+    except sqlite3.IntegrityError:
+        raise ValueError(duplicate_msg)
+    logging.info("Casos agregados en lote: %s (por %s)", len(data), creado_por)
+    return len(data)
+
+
+def add_abonos_bulk(conn, rows, creado_por=None):
+    """
+    Inserts many abonos in a single transaction.
+    rows: iterable of (fecha, monto, caso_id, observaciones). Validation matches add_abono.
+    """
+    data = []
+    for n, (fecha, monto, caso_id, observaciones) in enumerate(rows, start=1):
+        caso_id_int, monto_val = _abono_ids_and_monto(caso_id, monto)
+        try:
+            fecha_iso = fecha_to_iso(fecha)
+        except ValueError:
+            raise ValueError(f"Fecha inválida en la fila {n}: {fecha!r}.")
+        data.append((fecha_iso, monto_val, caso_id_int, observaciones, creado_por))
+    try:
+        with conn:
+            # looked up under the connection's transaction lock, so another session of this
+            # user can't delete a caso between the check and the insert
+            existing_ids = {r[0] for r in conn.execute("SELECT id FROM casos")}
+            for row in data:
+                # checked up front so the error names the offending caso
+                if row[2] not in existing_ids:
+                    raise ValueError(f"No existe el caso con id {row[2]}.")
+            conn.executemany(
+                "INSERT INTO abonos (fecha, monto, caso_id, observaciones, creado_por) VALUES (?,?,?,?,?)",
+                data,
+            )
+    except sqlite3.IntegrityError:
+        # a caso deleted from outside this process after the lookup
+        raise ValueError("Algún caso del archivo ya no existe; no se importó ningún abono.")
+    logging.info("Abonos agregados en lote: %s (por %s)", len(data), creado_por)
+    return len(data)
+
+
 def delete_abono(conn, abono_id):
-    c = conn.cursor()
-    c.execute("DELETE FROM abonos WHERE id = ?", (abono_id,))
-    conn.commit()
+    with conn:
+        conn.execute("DELETE FROM abonos WHERE id = ?", (abono_id,))
     logging.info("Abono eliminado id=%s", abono_id)
 
 
 # ------------------ Reports / Exports ------------------
 
 
-def resumen_por_caso(conn, cliente_filter=None, etapa_filter=None):
-    casos = fetch_casos(conn, cliente_filter, etapa_filter)
-    if casos.empty:
-        return pd.DataFrame(columns=["id", "cliente", "descripcion", "valor_acordado", "total_abonado", "saldo_pendiente", "etapa", "observaciones"])
-    abonos = pd.read_sql_query("SELECT caso_id, SUM(monto) as total_abonado FROM abonos GROUP BY caso_id", conn)
-    merged = casos.merge(abonos, left_on="id", right_on="caso_id", how="left")
-    merged["total_abonado"] = merged["total_abonado"].fillna(0.0)
-    merged["saldo_pendiente"] = merged["valor_acordado"] - merged["total_abonado"]
-    result = merged[["id", "cliente", "descripcion", "valor_acordado", "total_abonado", "saldo_pendiente", "etapa", "observaciones"]].copy()
-    result["valor_acordado"] = result["valor_acordado"].astype(float)
-    result["total_abonado"] = result["total_abonado"].astype(float)
-    result["saldo_pendiente"] = result["saldo_pendiente"].astype(float)
-    return result
+def distinct_clientes(casos_df: pd.DataFrame) -> list[str]:
+    # taken from the casos frame main() already holds, no extra query
+    return sorted(casos_df["cliente"].dropna().unique())
+
+
+def distinct_etapas(casos_df: pd.DataFrame) -> list[str]:
+    # NULL etapa is listed as "", like the etapa text inputs show it
+    return sorted(casos_df["etapa"].fillna("").unique())
 
 
-def to_csv_bytes(df: pd.DataFrame) -> bytes:
-    return df.to_csv(index=False).encode("utf-8")
+def _resumen_query(cliente_filter=None, etapa_filter=None) -> tuple[str, tuple]:
+    q = """SELECT c.id, c.cliente, c.descripcion, c.valor_acordado,
+                  COALESCE(SUM(a.monto), 0.0) AS total_abonado,
+                  c.valor_acordado - COALESCE(SUM(a.monto), 0.0) AS saldo_pendiente,
+                  c.etapa, c.observaciones
+           FROM casos c LEFT JOIN abonos a ON a.caso_id = c.id"""
+    where, params = _build_caso_where(cliente_filter, etapa_filter, alias="c.")
+    return q + where + " GROUP BY c.id ORDER BY c.id", tuple(params)
 
 
-def to_excel_bytes(df: pd.DataFrame) -> bytes:
+def resumen_in_memory(casos_df: pd.DataFrame, abonos_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Same rows and columns as _resumen_query (used for the CSV export), computed from the
+    casos/abonos frames main() already holds, so the Resumen/Reportes tabs need no extra query.
+    """
+    totals = abonos_df.groupby("caso_id", sort=False)["monto"].sum()
+    valor = casos_df["valor_acordado"].astype(float)
+    # Series.map aligns on caso_id without a merge; casos without abonos get 0
+    total_abonado = casos_df["id"].map(totals).fillna(0.0).astype(float)
+    return pd.DataFrame({
+        "id": casos_df["id"],
+        "cliente": casos_df["cliente"],
+        "descripcion": casos_df["descripcion"],
+        "valor_acordado": valor,
+        "total_abonado": total_abonado,
+        "saldo_pendiente": valor - total_abonado,
+        "etapa": casos_df["etapa"],
+        "observaciones": casos_df["observaciones"],
+    })
+
+
+def resumen_csv_bytes(conn, cliente_filter=None, etapa_filter=None) -> bytes:
+    # same rows as resumen_in_memory, written straight from the cursor: no DataFrame for the CSV export
+    q, params = _resumen_query(cliente_filter, etapa_filter)
+    cursor = conn.execute(q, params)
     buffer = BytesIO()
-    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Resumen")
-        ws = writer.sheets["Resumen"]
-        header_fill = PatternFill(start_color="1F4E78", end_color="1F4E78", fill_type="solid")
-        header_font = Font(color="FFFFFF", bold=True)
-        header_alignment = Alignment(horizontal="center", vertical="center")
-        thin = Side(border_style="thin", color="AAAAAA")
-        border = Border(left=thin, right=thin, top=thin, bottom=thin)
-        for cell in ws[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = header_alignment
-        for row in ws.iter_rows(min_row=1, max_row=ws.max_row):
-            for cell in row:
-                cell.border = border
-                cell.alignment = Alignment(vertical="center")
-        for column_cells in ws.columns:
-            length = max(len(str(cell.value)) if cell.value is not None else 0 for cell in column_cells)
-            ws.column_dimensions[get_column_letter(column_cells[0].column)].width = min(length + 4, 60)
-        for col in ws.iter_cols(min_row=2, max_row=ws.max_row):
-            if all((isinstance(c.value, (int, float)) or c.value is None) for c in col):
-                for cell in col:
-                    cell.number_format = "#,##0.00"
-    buffer.seek(0)
-    return buffer.read()
+    wrapper = TextIOWrapper(buffer, encoding="utf-8", newline="")
+    writer = csv.writer(wrapper, lineterminator="\n")
+    writer.writerow([col[0] for col in cursor.description])
+    writer.writerows(cursor)
+    wrapper.flush()
+    wrapper.detach()
+    return buffer.getvalue()
+
+
+# export styles, shared by both Excel engines and built once at import instead of per export
+EXCEL_HEADER_COLOR = "1F4E78"
+EXCEL_BORDER_COLOR = "AAAAAA"
+EXCEL_MONEY_FORMAT = "#,##0.00"
+EXCEL_DATE_FORMAT = "yyyy-mm-dd"
+
+_HEADER_FILL = PatternFill(start_color=EXCEL_HEADER_COLOR, end_color=EXCEL_HEADER_COLOR, fill_type="solid")
+_HEADER_FONT = Font(color="FFFFFF", bold=True)
+_HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="center")
+_CELL_ALIGNMENT = Alignment(vertical="center")
+_THIN = Side(border_style="thin", color=EXCEL_BORDER_COLOR)
+_CELL_BORDER = Border(left=_THIN, right=_THIN, top=_THIN, bottom=_THIN)
+
+# xlsxwriter formats are bound to a workbook, so only their properties can be shared
+_XLSX_CELL = {"valign": "vcenter", "border": 1, "border_color": f"#{EXCEL_BORDER_COLOR}"}
+_XLSX_HEADER = {**_XLSX_CELL, "bold": True, "font_color": "#FFFFFF", "bg_color": f"#{EXCEL_HEADER_COLOR}", "align": "center"}
+_XLSX_NUMBER = {**_XLSX_CELL, "num_format": EXCEL_MONEY_FORMAT}
+_XLSX_DATE = {**_XLSX_CELL, "num_format": EXCEL_DATE_FORMAT}
+
+
+def _excel_column_values(s: pd.Series) -> list:
+    # plain Python values for the writers: datetimes as datetime, missing values as None
+    if pd.api.types.is_datetime64_any_dtype(s.dtype):
+        values = list(s.dt.to_pydatetime())
+    else:
+        values = s.tolist()
+    if s.hasnans:
+        values = [None if missing else v for v, missing in zip(values, s.isna().to_numpy())]
+    return values
+
+
+def _excel_columns(df: pd.DataFrame) -> list[list]:
+    # extracted once per export; feeds both the widths and the rows (zip(*columns))
+    return [_excel_column_values(df[col]) for col in df.columns]
+
+
+def _excel_column_widths(df: pd.DataFrame, columns: list[list]) -> list[int]:
+    # computed from the extracted values (header included), never from the written cells
+    widths = []
+    for col, dtype, values in zip(df.columns, df.dtypes, columns):
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            longest = 10 if any(v is not None for v in values) else 0  # written as yyyy-mm-dd
+        else:
+            longest = max((len(str(v)) for v in values if v is not None), default=0)
+        widths.append(min(max(len(str(col)), longest) + 4, 60))
+    return widths
+
+
+def _write_xlsxwriter(target, df: pd.DataFrame, options: dict):
+    wb = xlsxwriter.Workbook(target, options)
+    ws = wb.add_worksheet("Resumen")
+    header_fmt = wb.add_format(_XLSX_HEADER)
+    cell_fmt = wb.add_format(_XLSX_CELL)
+    number_fmt = wb.add_format(_XLSX_NUMBER)
+    date_fmt = wb.add_format(_XLSX_DATE)
+
+    col_formats = [number_fmt if pd.api.types.is_numeric_dtype(dtype) else cell_fmt for dtype in df.dtypes]
+    columns = _excel_columns(df)
+    for i, width in enumerate(_excel_column_widths(df, columns)):
+        ws.set_column(i, i, width)
+    ws.write_row(0, 0, [str(col) for col in df.columns], header_fmt)
+    # rows are written in order, as constant_memory requires
+    # (pandas' to_excel writes column by column, which would drop data in that mode)
+    for r, row in enumerate(zip(*columns), start=1):
+        for c, value in enumerate(row):
+            ws.write(r, c, value, date_fmt if isinstance(value, date) else col_formats[c])
+    wb.close()
+
+
+def _to_excel_bytes_xlsxwriter(df: pd.DataFrame) -> bytes:
+    if len(df) < EXCEL_CONSTANT_MEMORY_ROWS:
+        buffer = BytesIO()
+        _write_xlsxwriter(buffer, df, {"in_memory": True})
+        return buffer.getvalue()
+    # constant_memory flushes each row as soon as the next one starts, keeping large exports flat
+    with tempfile.TemporaryFile(suffix=".xlsx") as tmp:
+        _write_xlsxwriter(tmp, df, {"constant_memory": True})
+        tmp.seek(0)
+        return tmp.read()
+
+
+def to_excel_bytes(df: pd.DataFrame, engine: str = "xlsxwriter") -> bytes:
+    """
+    engine: "xlsxwriter" (default; constant memory from EXCEL_CONSTANT_MEMORY_ROWS rows up)
+    or "openpyxl".
+    """
+    if engine == "xlsxwriter":
+        return _to_excel_bytes_xlsxwriter(df)
+    if engine != "openpyxl":
+        raise ValueError(f"Motor de Excel no soportado: {engine}")
+    # write-only workbook: rows are streamed once, styles are set on the cells as they are written
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Resumen")
+    # one named style per kind of data cell: assigning a name is much cheaper than border + alignment + format per cell
+    wb.add_named_style(NamedStyle("celda", border=_CELL_BORDER, alignment=_CELL_ALIGNMENT))
+    wb.add_named_style(NamedStyle("celda_numero", border=_CELL_BORDER, alignment=_CELL_ALIGNMENT, number_format=EXCEL_MONEY_FORMAT))
+    wb.add_named_style(NamedStyle("celda_fecha", border=_CELL_BORDER, alignment=_CELL_ALIGNMENT, number_format=EXCEL_DATE_FORMAT))
+    col_styles = [
+        "celda_fecha" if pd.api.types.is_datetime64_any_dtype(dtype)
+        else "celda_numero" if pd.api.types.is_numeric_dtype(dtype)
+        else "celda"
+        for dtype in df.dtypes
+    ]
+    columns = _excel_columns(df)
+    # widths must be set before the first append
+    for i, width in enumerate(_excel_column_widths(df, columns)):
+        ws.column_dimensions[get_column_letter(i + 1)].width = width
+
+    header_cells = []
+    for col in df.columns:
+        cell = WriteOnlyCell(ws, value=str(col))
+        cell.fill = _HEADER_FILL
+        cell.font = _HEADER_FONT
+        cell.alignment = _HEADER_ALIGNMENT
+        cell.border = _CELL_BORDER
+        header_cells.append(cell)
+    ws.append(header_cells)
+
+    for row in zip(*columns):
+        cells = []
+        for value, style in zip(row, col_styles):
+            cell = WriteOnlyCell(ws, value=value)
+            cell.style = style
+            cells.append(cell)
+        ws.append(cells)
+
+    # serialize to a temp file and read it back once, instead of holding a BytesIO next to its bytes copy
+    with tempfile.TemporaryFile(suffix=".xlsx") as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        return tmp.read()
+
+
+# ------------------ Imports ------------------
+
+CASOS_CSV_COLUMNS = ["cliente", "descripcion", "valor_acordado", "etapa", "observaciones"]
+ABONOS_CSV_COLUMNS = ["fecha", "monto", "caso_id", "observaciones"]
+
+
+def import_csv(conn, tipo: str, file, creado_por=None) -> int:
+    """
+    Bulk-loads a CSV into casos or abonos (tipo "Casos" / "Abonos").
+    Missing optional columns are filled with "", missing required ones raise ValueError.
+    """
+    if tipo == "Casos":
+        columns, required, bulk = CASOS_CSV_COLUMNS, ["cliente"], add_casos_bulk
+    else:
+        columns, required, bulk = ABONOS_CSV_COLUMNS, ["fecha", "monto", "caso_id"], add_abonos_bulk
+    df = pd.read_csv(file, dtype=str, keep_default_na=False)
+    missing = [col for col in required if col not in df.columns]
+    if missing:
+        raise ValueError(f"Faltan columnas en el CSV: {', '.join(missing)}.")
+    rows = df.reindex(columns=columns, fill_value="").itertuples(index=False, name=None)
+    return bulk(conn, rows, creado_por=creado_por)
+
+
+# ------------------ Cached reads ------------------
+
+# writes made through the app bump the data version; READ_CACHE_TTL only bounds how long
+# changes made outside the app (e.g. a restored .db file) can stay hidden (see read_token)
+READ_CACHE_TTL = 300
+READ_CACHE_ENTRIES = 128
+# sessions run on separate threads; guards the read-modify-write in _bump_path_version
+_DATA_VERSIONS_LOCK = threading.Lock()
+
+
+@st.cache_resource(show_spinner=False)
+def _data_versions() -> dict:
+    # process-wide {db_path: version}, so every session of a user sees the same version
+    return {}
+
+
+def get_data_version(username: str) -> int:
+    return _data_versions().get(get_db_path_for_user(username), 0)
+
+
+def _bump_path_version(db_path: str):
+    versions = _data_versions()
+    with _DATA_VERSIONS_LOCK:
+        versions[db_path] = versions.get(db_path, 0) + 1
+
+
+def read_token(username: str) -> tuple[int, int]:
+    """
+    Key for every cached read and session memo of the user's data: (data version, TTL epoch).
+    The epoch advances every READ_CACHE_TTL seconds, so the tables, memos and exports all
+    refresh together instead of each cache expiring on its own clock.
+    """
+    return get_data_version(username), int(time.time() // READ_CACHE_TTL)
+
+
+def bump_data_version(username: str):
+    """Invalidates the cached reads for the user's DB. Call after every write."""
+    _bump_path_version(get_db_path_for_user(username))
+
+
+@st.cache_data(show_spinner=False, max_entries=READ_CACHE_ENTRIES)
+def _cached_casos(username: str, token: tuple[int, int], cliente_filter=None, etapa_filter=None):
+    if cliente_filter or etapa_filter:
+        # filter combinations are sliced from the cached full table instead of re-querying SQLite
+        return filter_by_caso(_cached_casos(username, token), cliente_filter, etapa_filter)
+    with read_conn(username) as conn:
+        return fetch_casos(conn)
+
+
+@st.cache_data(show_spinner=False, max_entries=READ_CACHE_ENTRIES)
+def _cached_abonos(username: str, token: tuple[int, int], caso_id=None):
+    with read_conn(username) as conn:
+        return fetch_abonos(conn, caso_id)
+
+
+@st.cache_data(show_spinner=False, max_entries=READ_CACHE_ENTRIES)
+def _cached_resumen_csv(username: str, token: tuple[int, int], cliente_filter=None, etapa_filter=None) -> bytes:
+    with read_conn(username) as conn:
+        return resumen_csv_bytes(conn, cliente_filter, etapa_filter)
+
+
+@st.cache_data(show_spinner=False, max_entries=READ_CACHE_ENTRIES)
+def _cached_resumen_excel(username: str, token: tuple[int, int], cliente_filter=None, etapa_filter=None) -> bytes:
+    # repeated clicks on the same data/filters return the bytes without rebuilding the workbook
+    resumen = resumen_in_memory(_cached_casos(username, token), _cached_abonos(username, token))
+    return to_excel_bytes(filter_by_caso(resumen, cliente_filter, etapa_filter))
+
+
+def memo_per_version(key: str, username: str, token: tuple[int, int], build):
+    """
+    Returns build(), kept in session_state until the user's read_token changes (a write or
+    a new TTL epoch), so interactive reruns (typing, switching tabs) skip rebuilding it.
+    token must be the one the frames passed to build() were read with (main() reads it once).
+    """
+    key_token = (username, token)
+    cached = st.session_state.get(key)
+    if cached is None or cached[0] != key_token:
+        cached = (key_token, build())
+        st.session_state[key] = cached
+    return cached[1]
+
+
+def indexed_by_id(name: str, df: pd.DataFrame, username: str, token: tuple[int, int]) -> pd.DataFrame:
+    # df.set_index("id") for O(1) row lookups in the edit forms
+    return memo_per_version(f"{name}_by_id", username, token, lambda: df.set_index("id", drop=False))
+
+
+def clear_read_caches():
+    _cached_casos.clear()
+    _cached_abonos.clear()
+    _cached_resumen_csv.clear()
+    _cached_resumen_excel.clear()
 
 
 # ------------------ UI Helpers ------------------
 
 
-def money(v):
-    try:
-        return f"${float(v):,.2f}"
-    except Exception:
-        return v
+def money(v: float) -> str:
+    # only used for the metric totals, which are always numeric sums
+    return f"${v:,.2f}"
+
+
+def case_options(casos_df: pd.DataFrame) -> list[tuple[int, str]]:
+    # (id, "id — cliente — descripcion") from plain column lists, no per-row Series
+    ids = casos_df["id"].tolist()
+    labels = [
+        f"{i} — {cliente} — {desc}"
+        for i, cliente, desc in zip(ids, casos_df["cliente"].tolist(), casos_df["descripcion"].fillna("").tolist())
+    ]
+    return list(zip(ids, labels))
+
+
+def abono_options(abonos_df: pd.DataFrame) -> list[tuple[int, str]]:
+    ids = abonos_df["id"].tolist()
+    fechas = abonos_df["fecha"].dt.strftime("%Y-%m-%d").tolist()
+    labels = [
+        f"{i} — {cliente} — {fecha} — ${monto:,.2f}"
+        for i, cliente, fecha, monto in zip(ids, abonos_df["cliente"].tolist(), fechas, abonos_df["monto"].astype(float).tolist())
+    ]
+    return list(zip(ids, labels))
+
+
+# bars shown in the Resumen saldo chart
+CHART_TOP_K = 20
+
+MONEY_COLUMNS = ("valor_acordado", "total_abonado", "saldo_pendiente")
+# money is formatted by the dataframe frontend: the columns stay numeric (sortable), no Python string pass
+MONEY_COLUMN_CONFIG = {col: st.column_config.NumberColumn(col, format="dollar") for col in MONEY_COLUMNS}
+
+
+def money_totals(resumen_df: pd.DataFrame) -> np.ndarray:
+    # one reduction over the three money columns (valor, abonado, saldo) for the metrics
+    # nansum: legacy rows with a NULL valor_acordado are skipped, as Series.sum() did
+    return np.nansum(resumen_df[list(MONEY_COLUMNS)].to_numpy(dtype=float), axis=0)
 
 
 # ------------------ Auth ------------------
 
 
+@st.cache_resource(show_spinner=False, ttl=300)
+def _credentials():
+    """
+    st.secrets['credentials'] flattened once into a plain {username: password} dict
+    (None when the section is missing). The TTL lets rotated secrets apply without a restart.
+    """
+    if "credentials" not in st.secrets:
+        return None
+    flat = {}
+    for user, stored in st.secrets["credentials"].items():
+        if hasattr(stored, "get"):
+            stored = stored.get("password", None)
+        if isinstance(stored, str):
+            flat[str(user)] = stored
+    return flat
+
+
 def check_password(user: str, password: str) -> bool:
     """
     Checks credentials in st.secrets['credentials'].
@@ -293,48 +913,15 @@ def check_password(user: str, password: str) -> bool:
       - credentials: {username: "password"}
       - credentials: {username: {password: "pwvalue"}}
     """
-    if "credentials" not in st.secrets:
+    creds = _credentials()
+    if creds is None:
         st.error("Aplicación no configurada: falta la sección [credentials] en los secretos.")
         return False
-    creds = st.secrets["credentials"]
-    stored = None
-    try:
-        if hasattr(creds, "__contains__") and user in creds:
-            stored = creds[user]
-    except Exception:
-        stored = None
-
+    stored = creds.get(user)
     if stored is None:
-        try:
-            stored = getattr(creds, user)
-        except Exception:
-            stored = None
-
-    if stored is None and hasattr(creds, "get"):
-        try:
-            stored = creds.get(user)
-        except Exception:
-            stored = None
-
-    if isinstance(stored, str):
-        return password == stored
-
-    if stored is not None:
-        try:
-            if hasattr(stored, "get"):
-                pw = stored.get("password", None)
-                if pw is not None:
-                    return pw == password
-        except Exception:
-            pass
-        try:
-            pw = getattr(stored, "password", None)
-            if pw is not None:
-                return pw == password
-        except Exception:
-            pass
-
-    return False
+        return False
+    # constant-time comparison; bytes so non-ASCII passwords are accepted
+    return hmac.compare_digest(stored.encode("utf-8"), (password or "").encode("utf-8"))
 
 
 # ------------------ Admin utilities ------------------
@@ -344,6 +931,18 @@ def list_db_files():
     return sorted(glob.glob("control_abonos_*.db"))
 
 
+def checkpoint_db(path: str):
+    # flush the WAL into the main file so copies of the .db are complete
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        logging.exception("No se pudo hacer checkpoint de %s", path)
+
+
 def read_file_bytes(path: str) -> bytes:
     with open(path, "rb") as f:
         return f.read()
@@ -362,8 +961,14 @@ def make_zip_of_files(file_paths: list[str]) -> bytes:
 
 
 def delete_file(path: str) -> tuple[bool, str]:
+    # release the app's own handles first, or the -wal/-shm (and on Windows the .db) stay in use
+    close_connections([path])
     try:
         os.remove(path)
+        # WAL mode leaves -wal/-shm files next to the DB
+        for sidecar in (path + "-wal", path + "-shm"):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
         return True, ""
     except Exception as e:
         logging.exception("Error borrando %s", path)
@@ -397,6 +1002,7 @@ def reset_all_databases_callback(admin_user: str, admin_pw_input: str):
                 deleted.append(f)
             else:
                 failed.append((f, err))
+        reset_connection_cache(deleted)
         msg = f"Borrados: {len(deleted)} archivos."
         if failed:
             msg += f" Fallos: {len(failed)}."
@@ -424,6 +1030,7 @@ def delete_db_callback(path: str):
             st.session_state["feedback"] = "Sólo admin puede borrar DBs."
             return
         ok, err = delete_file(path)
+        reset_connection_cache([path])
         if ok:
             st.session_state["feedback"] = f"Borrado: {os.path.basename(path)}"
         else:
@@ -439,6 +1046,7 @@ def delete_db_callback(path: str):
 
 def download_db_to_session(path: str, key: str):
     try:
+        checkpoint_db(path)
         b = read_file_bytes(path)
         st.session_state[key] = b
     except Exception as e:
@@ -462,6 +1070,8 @@ def generate_zip_all_callback():
         if not files:
             st.session_state["feedback"] = "No se encontraron bases de datos para archivar."
             return
+        for f in files:
+            checkpoint_db(f)
         zip_bytes = make_zip_of_files(files)
         st.session_state["zip_all_bytes"] = zip_bytes
         st.session_state["feedback"] = f"ZIP listo ({len(files)} archivos). Usa el botón para descargar."
@@ -487,6 +1097,7 @@ def delete_user_db_callback(username_input: str):
             st.session_state["feedback"] = f"No existe la DB para usuario {username_input}."
             return
         ok, err = delete_file(path)
+        reset_connection_cache([path])
         if ok:
             st.session_state["feedback"] = f"DB de {username_input} borrada."
         else:
@@ -505,8 +1116,7 @@ def delete_user_db_callback(username_input: str):
 
 def submit_new_case(usuario: str):
     try:
-        conn = get_connection_for_user(usuario)
-        init_db(conn)
+        conn = get_conn(usuario)
         add_caso(
             conn,
             st.session_state.get("new_cliente", ""),
@@ -516,6 +1126,7 @@ def submit_new_case(usuario: str):
             st.session_state.get("new_obs", ""),
             creado_por=usuario,
         )
+        bump_data_version(usuario)
         # clear state keys (safe inside callback)
         st.session_state["new_cliente"] = ""
         st.session_state["new_valor"] = 0.0
@@ -534,8 +1145,7 @@ def submit_new_case(usuario: str):
 
 def submit_new_abono(usuario: str):
     try:
-        conn = get_connection_for_user(usuario)
-        init_db(conn)
+        conn = get_conn(usuario)
         case_selected = st.session_state.get("abono_case")
         caso_id_selected = case_selected[0] if isinstance(case_selected, tuple) else case_selected
         fecha_val = st.session_state.get("abono_fecha", date.today())
@@ -552,6 +1162,7 @@ def submit_new_abono(usuario: str):
             st.session_state.get("abono_obs", ""),
             creado_por=usuario,
         )
+        bump_data_version(usuario)
         # clear fields
         st.session_state["abono_monto"] = 0.0
         st.session_state["abono_obs"] = ""
@@ -570,6 +1181,14 @@ def submit_new_abono(usuario: str):
 
 # ------------------ Main ------------------
 
+# static page styles; still emitted on every rerun, since Streamlit drops elements a run doesn't render
+_PAGE_CSS = """
+<style>
+    .big-title { font-size:28px; font-weight:700; color:#0b3d91; }
+    .subtle { color: #4b5563; }
+</style>
+"""
+
 
 def main():
     st.set_page_config(page_title="Control de Abonos - Dashboard", layout="wide")
@@ -597,15 +1216,9 @@ def main():
             st.stop()
 
     usuario = st.session_state.get("usuario")
-    conn = get_connection_for_user(usuario)
-    init_db(conn)
+    conn = get_conn(usuario)
 
-    st.markdown("""
-    <style>
-        .big-title { font-size:28px; font-weight:700; color:#0b3d91; }
-        .subtle { color: #4b5563; }
-    </style>
-    """, unsafe_allow_html=True)
+    st.markdown(_PAGE_CSS, unsafe_allow_html=True)
 
     col1, col2 = st.columns([1, 4])
     with col1:
@@ -628,8 +1241,19 @@ def main():
     st.session_state.setdefault("feedback", "")
 
     # fetch fresh
-    casos_df = fetch_casos(conn)
-    abonos_df = fetch_abonos(conn)
+    # read once per run: every cached read, memo and download below uses this same token,
+    # so a write from another session mid-run can't pair frames of one version with another's key
+    token = read_token(usuario)
+    casos_df = _cached_casos(usuario, token)
+    abonos_df = _cached_abonos(usuario, token)
+    casos_by_id = indexed_by_id("casos", casos_df, usuario, token)
+    abonos_by_id = indexed_by_id("abonos", abonos_df, usuario, token)
+    # (id, label) pairs shared by every caso selectbox below
+    opciones_casos = memo_per_version("opciones_casos", usuario, token, lambda: case_options(casos_df))
+    # resumen for every caso, derived from the frames above instead of another query
+    resumen_all = memo_per_version("resumen_all", usuario, token, lambda: resumen_in_memory(casos_df, abonos_df))
+    # caso id -> position in opciones_casos, for the selectbox default index
+    caso_pos = memo_per_version("caso_pos", usuario, token, lambda: {cid: i for i, (cid, _) in enumerate(opciones_casos)})
 
     tab_casos, tab_abonos, tab_resumen, tab_reportes = st.tabs(["Casos", "Abonos", "Resumen", "Reportes"])
 
@@ -656,17 +1280,15 @@ def main():
         st.button("Agregar Caso", key="btn_add_caso", on_click=submit_new_case, args=(usuario,))
 
         # lista y edición
-        casos_now = fetch_casos(conn)
-        if not casos_now.empty:
+        if not casos_df.empty:
             st.markdown("### Lista de casos")
-            st.dataframe(casos_now, width="stretch")
+            st.dataframe(casos_df, width="stretch")
             st.markdown("#### Editar / Eliminar caso")
-            opciones_casos = [(int(r["id"]), f"{r['id']} — {r['cliente']} — {r['descripcion'] or ''}") for _, r in casos_now.iterrows()]
             seleccionado = st.selectbox("Selecciona caso", options=opciones_casos, format_func=lambda x: x[1], key="select_case_edit")
             caso_id_sel = seleccionado[0] if isinstance(seleccionado, tuple) else seleccionado
 
             with st.form("form_caso_edit"):
-                c_row = casos_now.loc[casos_now["id"] == caso_id_sel].iloc[0]
+                c_row = casos_by_id.loc[caso_id_sel]
                 cliente_e = st.text_input("Cliente", value=c_row["cliente"], key="cliente_edit")
                 descripcion_e = st.text_input("Descripción", value=c_row["descripcion"], key="desc_edit")
                 valor_e = st.number_input("Valor acordado", value=float(c_row["valor_acordado"]), min_value=0.0, step=100.0, format="%.2f", key="valor_edit")
@@ -676,10 +1298,14 @@ def main():
                 if btns[0].form_submit_button("Guardar cambios"):
                     try:
                         edit_caso(conn, caso_id_sel, cliente_e, descripcion_e, valor_e, etapa_e, obs_e)
-                        st.success("Caso actualizado.")
+                        bump_data_version(usuario)
+                        st.session_state["feedback"] = "Caso actualizado."
                     except Exception:
                         logging.exception("Error editando caso")
                         st.error("Error al actualizar el caso. Revisa los logs.")
+                    else:
+                        # reload the frames fetched at the top of main()
+                        st.rerun()
                 confirm_delete = st.checkbox("Confirmo eliminación de este caso (y sus abonos).", key=f"confirm_case_{caso_id_sel}")
                 if btns[1].form_submit_button("Eliminar caso"):
                     if not confirm_delete:
@@ -687,35 +1313,37 @@ def main():
                     else:
                         try:
                             delete_caso(conn, caso_id_sel)
-                            st.success("Caso eliminado.")
+                            bump_data_version(usuario)
+                            st.session_state["feedback"] = "Caso eliminado."
                         except Exception:
                             logging.exception("Error eliminando caso")
                             st.error("Error al eliminar el caso. Revisa los logs.")
+                        else:
+                            # reload the frames fetched at the top of main()
+                            st.rerun()
 
     # ---------- ABONOS ----------
     with tab_abonos:
         st.subheader("💰 Abonos")
-        casos_now = fetch_casos(conn)
-        if casos_now.empty:
+        if casos_df.empty:
             st.info("Registra primero al menos un caso para agregar abonos.")
         else:
             st.markdown("Agregar nuevo abono (pulsa el botón 'Agregar Abono' para enviar).")
-            opciones = [(int(r["id"]), f"{r['id']} — {r['cliente']} — {r['descripcion'] or ''}") for _, r in casos_now.iterrows()]
 
             # ensure default select option exists
-            if opciones and st.session_state.get("abono_case") is None:
-                st.session_state["abono_case"] = opciones[0]
+            if opciones_casos and st.session_state.get("abono_case") is None:
+                st.session_state["abono_case"] = opciones_casos[0]
 
             # compute default index safely
             default_index = 0
             try:
                 stored = st.session_state.get("abono_case")
                 stored_id = stored[0] if isinstance(stored, tuple) else stored
-                default_index = next((i for i, o in enumerate(opciones) if o[0] == stored_id), 0)
+                default_index = caso_pos.get(stored_id, 0)
             except Exception:
                 default_index = 0
 
-            st.selectbox("Selecciona Caso", options=opciones, format_func=lambda x: x[1], index=default_index, key="abono_case")
+            st.selectbox("Selecciona Caso", options=opciones_casos, format_func=lambda x: x[1], index=default_index, key="abono_case")
             st.date_input("Fecha", value=st.session_state["abono_fecha"], key="abono_fecha")
             st.number_input("Monto", min_value=0.0, step=100.0, format="%.2f", key="abono_monto", value=st.session_state["abono_monto"])
             st.text_area("Observaciones", key="abono_obs", value=st.session_state["abono_obs"])
@@ -723,31 +1351,42 @@ def main():
             st.button("Agregar Abono", key="btn_add_abono", on_click=submit_new_abono, args=(usuario,))
 
         # Mostrar abonos y edición
-        abonos = fetch_abonos(conn)
-        if not abonos.empty:
+        if not abonos_df.empty:
             st.markdown("### Últimos abonos")
-            st.dataframe(abonos, width="stretch")
+            st.dataframe(abonos_df, width="stretch", column_config={"fecha": st.column_config.DateColumn("fecha", format="YYYY-MM-DD")})
 
             st.markdown("#### Editar / Eliminar abono")
-            opciones_abonos = [(int(r["id"]), f"{r['id']} — {r['cliente']} — {r['fecha']} — ${float(r['monto']):,.2f}") for _, r in abonos.iterrows()]
+            opciones_abonos = memo_per_version("opciones_abonos", usuario, token, lambda: abono_options(abonos_df))
             elegido = st.selectbox("Selecciona abono", options=opciones_abonos, format_func=lambda x: x[1], key="select_abono_edit")
             abono_id_sel = elegido[0] if isinstance(elegido, tuple) else elegido
 
             with st.form("form_abono_edit"):
-                a_row = abonos.loc[abonos["id"] == abono_id_sel].iloc[0]
-                caso_index = [o[0] for o in opciones].index(int(a_row["caso_id"])) if opciones else 0
-                st.selectbox("Caso (editar)", options=opciones, format_func=lambda x: x[1], index=caso_index, key="case_edit_abono")
-                st.date_input("Fecha", value=pd.to_datetime(a_row["fecha"]).date(), key="fecha_edit")
+                a_row = abonos_by_id.loc[abono_id_sel]
+                caso_index = caso_pos.get(int(a_row["caso_id"]), 0)
+                st.selectbox("Caso (editar)", options=opciones_casos, format_func=lambda x: x[1], index=caso_index, key="case_edit_abono")
+                # fecha is already datetime64 (parsed once in fetch_abonos); unparseable dates come back as NaT
+                fecha_actual = a_row["fecha"]
+                if pd.isna(fecha_actual):
+                    # left empty rather than pre-filled, so saving can't silently replace the stored date
+                    st.warning("La fecha guardada de este abono no es válida. Elige la fecha correcta antes de guardar.")
+                st.date_input("Fecha", value=fecha_actual.date() if pd.notna(fecha_actual) else None, key="fecha_edit")
                 st.number_input("Monto", value=float(a_row["monto"]), min_value=0.0, step=100.0, format="%.2f", key="monto_edit")
                 st.text_area("Observaciones", value=a_row["observaciones"], key="obs_abono_edit")
                 btns_ab = st.columns([1, 1])
                 if btns_ab[0].form_submit_button("Guardar cambios"):
-                    try:
-                        edit_abono(conn, abono_id_sel, st.session_state["fecha_edit"], st.session_state["monto_edit"], st.session_state["case_edit_abono"][0], st.session_state["obs_abono_edit"])
-                        st.success("Abono actualizado.")
-                    except Exception:
-                        logging.exception("Error editando abono")
-                        st.error("Error al actualizar el abono. Revisa los logs.")
+                    if st.session_state["fecha_edit"] is None:
+                        st.error("Selecciona la fecha del abono.")
+                    else:
+                        try:
+                            edit_abono(conn, abono_id_sel, st.session_state["fecha_edit"], st.session_state["monto_edit"], st.session_state["case_edit_abono"][0], st.session_state["obs_abono_edit"])
+                            bump_data_version(usuario)
+                            st.session_state["feedback"] = "Abono actualizado."
+                        except Exception:
+                            logging.exception("Error editando abono")
+                            st.error("Error al actualizar el abono. Revisa los logs.")
+                        else:
+                            # reload the frames fetched at the top of main()
+                            st.rerun()
                 confirm_delete_ab = st.checkbox("Confirmo eliminación de este abono.", key=f"confirm_ab_{abono_id_sel}")
                 if btns_ab[1].form_submit_button("Eliminar abono"):
                     if not confirm_delete_ab:
@@ -755,45 +1394,45 @@ def main():
                     else:
                         try:
                             delete_abono(conn, abono_id_sel)
-                            st.success("Abono eliminado.")
+                            bump_data_version(usuario)
+                            st.session_state["feedback"] = "Abono eliminado."
                         except Exception:
                             logging.exception("Error eliminando abono")
                             st.error("Error al eliminar el abono. Revisa los logs.")
+                        else:
+                            # reload the frames fetched at the top of main()
+                            st.rerun()
 
     # ---------- RESUMEN ----------
     with tab_resumen:
         st.subheader("📊 Resumen por Caso")
-        casos_all = fetch_casos(conn)
-        clientes = ["Todos"] + sorted(list(casos_all["cliente"].dropna().unique())) if not casos_all.empty else ["Todos"]
-        etapas = ["Todos"] + sorted(list(casos_all["etapa"].fillna("").unique()))
+        clientes, etapas = memo_per_version("filtros_resumen", usuario, token, lambda: (
+            ["Todos"] + distinct_clientes(casos_df),
+            ["Todos"] + distinct_etapas(casos_df),
+        ))
         cliente_filter = st.selectbox("Filtrar por cliente", clientes, key="filter_cliente")
         etapa_filter = st.selectbox("Filtrar por etapa", etapas, key="filter_etapa")
 
-        resumen_df = resumen_por_caso(conn, cliente_filter=cliente_filter, etapa_filter=etapa_filter)
+        resumen_df = filter_by_caso(resumen_all, cliente_filter, etapa_filter)
         if resumen_df.empty:
             st.info("No hay datos disponibles con los filtros seleccionados.")
         else:
-            total_acordado = resumen_df["valor_acordado"].sum()
-            total_abonado = resumen_df["total_abonado"].sum()
-            total_pendiente = resumen_df["saldo_pendiente"].sum()
+            total_acordado, total_abonado, total_pendiente = money_totals(resumen_df)
             colA, colB, colC = st.columns(3)
             colA.metric("Total valor acordado", money(total_acordado))
             colB.metric("Total abonado", money(total_abonado))
             colC.metric("Total saldo pendiente", money(total_pendiente))
-            display = resumen_df.copy()
-            display["estado"] = display["saldo_pendiente"].apply(lambda x: "Pendiente" if x > 0.0 else "Pagado")
-            display["valor_acordado"] = display["valor_acordado"].apply(money)
-            display["total_abonado"] = display["total_abonado"].apply(money)
-            display["saldo_pendiente"] = display["saldo_pendiente"].apply(money)
-            st.dataframe(display, width="stretch")
+            display = resumen_df.assign(estado=np.where(resumen_df["saldo_pendiente"].to_numpy() > 0.0, "Pendiente", "Pagado"))
+            st.dataframe(display, width="stretch", column_config=MONEY_COLUMN_CONFIG)
+            # only the largest saldos are charted: nlargest selects them without sorting every caso
+            top_pendientes = resumen_df.nlargest(CHART_TOP_K, "saldo_pendiente")
             try:
-                chart_df = resumen_df.set_index("descripcion")[["saldo_pendiente"]].sort_values("saldo_pendiente", ascending=False)
-                st.bar_chart(chart_df, height=300)
+                st.bar_chart(top_pendientes.set_index("descripcion")[["saldo_pendiente"]], height=300)
             except Exception:
-                chart_df = resumen_df.set_index("cliente")[["saldo_pendiente"]].sort_values("saldo_pendiente", ascending=False)
-                st.bar_chart(chart_df, height=300)
-            st.download_button("⬇️ Exportar Resumen a CSV", data=to_csv_bytes(resumen_df), file_name="resumen_abonos.csv", mime="text/csv")
-            st.download_button("⬇️ Exportar Resumen a Excel", data=to_excel_bytes(resumen_df), file_name="resumen_abonos.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+                st.bar_chart(top_pendientes.set_index("cliente")[["saldo_pendiente"]], height=300)
+            st.download_button("⬇️ Exportar Resumen a CSV", data=_cached_resumen_csv(usuario, token, cliente_filter, etapa_filter), file_name="resumen_abonos.csv", mime="text/csv")
+            # Excel is built only when the button is clicked (Streamlit calls the callable then)
+            st.download_button("⬇️ Exportar Resumen a Excel", data=functools.partial(_cached_resumen_excel, usuario, token, cliente_filter, etapa_filter), file_name="resumen_abonos.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
     # ---------- ADMIN (RESET / BACKUP / DOWNLOAD / DELETE per user) ----------
     creds = st.secrets.get("credentials", {}) if "credentials" in st.secrets else {}
@@ -850,24 +1489,38 @@ def main():
     # ---------- REPORTES ----------
     with tab_reportes:
         st.subheader("📑 Reportes y Exportes globales")
-        df_export = resumen_por_caso(conn)
+        df_export = resumen_all
         if df_export.empty:
             st.info("No hay datos para exportar.")
         else:
-            total_acordado = df_export["valor_acordado"].sum()
-            total_abonado = df_export["total_abonado"].sum()
-            total_pendiente = df_export["saldo_pendiente"].sum()
+            total_acordado, total_abonado, total_pendiente = money_totals(df_export)
             r1, r2, r3 = st.columns(3)
             r1.metric("Total valor acordado", money(total_acordado))
             r2.metric("Total abonado", money(total_abonado))
             r3.metric("Total saldo pendiente", money(total_pendiente))
-            st.dataframe(df_export.assign(
-                valor_acordado=df_export["valor_acordado"].apply(money),
-                total_abonado=df_export["total_abonado"].apply(money),
-                saldo_pendiente=df_export["saldo_pendiente"].apply(money),
-            ), width="stretch")
-            st.download_button("⬇️ Exportar CSV (Global)", data=to_csv_bytes(df_export), file_name="resumen_abonos_global.csv", mime="text/csv")
-            st.download_button("⬇️ Exportar Excel (Global)", data=to_excel_bytes(df_export), file_name="resumen_abonos_global.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            st.dataframe(df_export, width="stretch", column_config=MONEY_COLUMN_CONFIG)
+            st.download_button("⬇️ Exportar CSV (Global)", data=_cached_resumen_csv(usuario, token), file_name="resumen_abonos_global.csv", mime="text/csv")
+            st.download_button("⬇️ Exportar Excel (Global)", data=functools.partial(_cached_resumen_excel, usuario, token), file_name="resumen_abonos_global.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+        st.markdown("---")
+        st.markdown("#### Importar CSV")
+        tipo_import = st.radio("Tipo de datos", ["Casos", "Abonos"], horizontal=True, key="import_tipo")
+        columnas = CASOS_CSV_COLUMNS if tipo_import == "Casos" else ABONOS_CSV_COLUMNS
+        st.caption("Columnas esperadas: " + ", ".join(columnas))
+        # the uploader's key changes after each import so the same file can't be imported twice
+        nonce = st.session_state.get("import_csv_nonce", 0)
+        archivo = st.file_uploader("Archivo CSV", type=["csv"], key=f"import_csv_file_{nonce}")
+        if st.button("Importar CSV", key="btn_import_csv", disabled=archivo is None):
+            try:
+                n = import_csv(conn, tipo_import, archivo, creado_por=usuario)
+                bump_data_version(usuario)
+                st.session_state["import_csv_nonce"] = nonce + 1
+                st.session_state["feedback"] = f"Importados {n} registros."
+            except Exception as e:
+                logging.exception("Error importando CSV")
+                st.error(f"Error al importar: {e}")
+            else:
+                st.rerun()
 
 
 def logout():